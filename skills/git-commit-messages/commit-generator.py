@@ -6,11 +6,43 @@ This script analyzes git changes and suggests commit messages
 following conventional commit standards.
 """
 
+import os
 import subprocess
 import re
 import sys
-from pathlib import Path
-from typing import List, Tuple, Optional
+from collections import Counter
+from typing import TYPE_CHECKING, Iterable, Iterator, List, Tuple, Optional
+
+if TYPE_CHECKING:
+    import pygit2  # imported for real in analyze_staged_changes(), if installed
+
+# File categories, matched against the lowercased path in this order
+_TEST_RE = re.compile(r'test|spec|__tests__')
+_CONFIG_RE = re.compile(r'config|package\.json|requirements\.txt|\.env')
+_DOC_RE = re.compile(r'readme|docs|\.md|\.txt')
+
+_CONFIG_EXTENSIONS = frozenset({'.json', '.yml', '.yaml', '.toml', '.ini'})
+
+# Top-level directories too generic to make a useful scope
+_GENERIC_SCOPES = frozenset({'src', 'lib', 'app', 'test', 'tests', 'docs'})
+
+# Commit type for each determine_commit_type() rule bit, highest priority first
+_TYPE_BY_RULE = {
+    1 << 0: 'test',      # every file is a test
+    1 << 1: 'docs',      # every file is documentation
+    1 << 2: 'chore',     # configuration files changed
+    1 << 3: 'feat',      # only new files
+    1 << 4: 'chore',     # only deleted files
+    1 << 5: 'feat',      # mostly additions
+    1 << 6: 'refactor',  # mostly deletions
+}
+
+# Environment variables that point git at another repository, work tree or
+# index; pygit2 ignores them, so their presence sends analysis to the CLI
+_GIT_LOCATION_VARS = ('GIT_DIR', 'GIT_WORK_TREE', 'GIT_COMMON_DIR', 'GIT_INDEX_FILE')
+
+# Separator under the report heading
+_RULE = '=' * 50
 
 def run_git_command(command: List[str]) -> str:
     """Run a git command and return the output."""
@@ -24,23 +56,102 @@ def run_git_command(command: List[str]) -> str:
         print(f"Error running git command: {e}")
         return ""
 
-def get_staged_changes() -> str:
-    """Get the diff of staged changes."""
-    return run_git_command(['diff', '--cached'])
+def stream_git_records(command: List[str]) -> Iterator[bytes]:
+    """Run a git command with -z output and yield its records as they arrive."""
+    proc = subprocess.Popen(['git'] + command,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    pending = b''
+    with proc.stdout:
+        # Read in fixed-size chunks so memory stays bounded by one chunk
+        while True:
+            chunk = proc.stdout.read(65536)
+            if not chunk:
+                break
+            records = (pending + chunk).split(b'\0')
+            pending = records.pop()
+            yield from records
+    if pending:
+        yield pending
+
+    if proc.wait() != 0:
+        print(f"Error running git command: git {' '.join(command)} "
+              f"returned non-zero exit status {proc.returncode}.")
+
+def get_staged_summary() -> Iterator[Tuple[str, str, int, int]]:
+    """Yield (status, path, lines added, lines deleted) for each staged file."""
+    # git drops --numstat output when --name-status is also given, so the
+    # status letters come from --raw. With -z that is one ":<modes> <shas>
+    # <status>" record per file followed by its path (two for renames and
+    # copies), then one "<added>\t<deleted>\t<path>" record per file in the
+    # same order, with "-" counts for binary files. Only paths are decoded.
+    fields = stream_git_records(['diff', '--cached', '--raw', '--numstat', '-z'])
+    files = []
+    numstat_index = 0
+
+    for field in fields:
+        if not field:
+            continue
+
+        # Raw record: status letter, then the path(s)
+        if field[:1] == b':':
+            status = field.rsplit(b' ', 1)[1][:1].decode('ascii')
+            path = next(fields)
+            if status in ('R', 'C'):
+                path = next(fields)
+            files.append((status, path.decode('utf-8', 'replace')))
+
+        # Numstat record: line counts, with the paths split out for renames
+        else:
+            added, deleted, path = field.split(b'\t', 2)
+            if not path:
+                next(fields)
+                next(fields)
+            status, path = files[numstat_index]
+            numstat_index += 1
+            if added == b'-':
+                yield status, path, 0, 0
+            else:
+                yield status, path, int(added), int(deleted)
 
 def get_unstaged_changes() -> str:
     """Get the diff of unstaged changes."""
     return run_git_command(['diff'])
 
-def analyze_changes(diff: str) -> dict:
-    """Analyze the diff to determine change characteristics."""
+def count_lines(repo: 'pygit2.Repository', diff_file: 'pygit2.DiffFile') -> int:
+    """Count the lines --numstat reports for one side of a type change."""
+    if diff_file.mode == 0o160000:  # submodule, shown as one "Subproject commit" line
+        return 1
+    blob = repo[diff_file.id]
+    if blob.is_binary:
+        return 0
+    data = blob.data
+    return data.count(b'\n') + (not data.endswith(b'\n') and len(data) > 0)
+
+def summarize_diff(repo: 'pygit2.Repository', diff: 'pygit2.Diff') -> Iterator[Tuple[str, str, int, int]]:
+    """Yield the same per-file records as get_staged_summary() from a pygit2 diff."""
+    diff.find_similar()  # detect renames, as git diff does by default
+
+    for patch in diff:
+        delta = patch.delta
+        status = delta.status_char()
+        if status == 'T':
+            # A type-change patch has no lines, but --numstat counts both sides
+            added = count_lines(repo, delta.new_file)
+            deleted = count_lines(repo, delta.old_file)
+        else:
+            _, added, deleted = patch.line_stats
+        yield status, delta.new_file.path, added, deleted
+
+def analyze_changes(summary: Iterable[Tuple[str, str, int, int]]) -> dict:
+    """Analyze the per-file staged change records to determine change characteristics."""
     analysis = {
         'has_new_files': False,
         'has_deleted_files': False,
         'has_modified_files': False,
         'has_renamed_files': False,
         'modified_extensions': set(),
-        'affected_paths': set(),
+        'affected_paths': [],
         'lines_added': 0,
         'lines_deleted': 0,
         'test_files': 0,
@@ -48,68 +159,106 @@ def analyze_changes(diff: str) -> dict:
         'doc_files': 0
     }
 
-    lines = diff.split('\n')
-    i = 0
-    while i < len(lines):
-        line = lines[i]
-
-        # File header
-        if line.startswith('diff --git'):
-            match = re.search(r'diff --git a/(.+) b/(.+)', line)
-            if match:
-                old_path = match.group(1)
-                new_path = match.group(2)
-                analysis['affected_paths'].add(new_path)
-
-                # Check file extension
-                ext = Path(new_path).suffix.lower()
-                if ext:
-                    analysis['modified_extensions'].add(ext)
-
-                # Categorize files
-                if any(test in new_path.lower() for test in ['test', 'spec', '__tests__']):
-                    analysis['test_files'] += 1
-                elif any(config in new_path.lower() for config in ['config', 'package.json', 'requirements.txt', '.env']):
-                    analysis['config_files'] += 1
-                elif any(doc in new_path.lower() for doc in ['readme', 'docs', '.md', '.txt']):
-                    analysis['doc_files'] += 1
-
-        # File status
-        elif line.startswith('new file mode'):
+    added = 0
+    deleted = 0
+
+    for status, path, file_added, file_deleted in summary:
+        added += file_added
+        deleted += file_deleted
+
+        if status == 'A':
             analysis['has_new_files'] = True
-        elif line.startswith('deleted file mode'):
+        elif status == 'D':
             analysis['has_deleted_files'] = True
-        elif line.startswith('rename'):
+        elif status == 'R':
             analysis['has_renamed_files'] = True
+        else:
+            analysis['has_modified_files'] = True
+
+        analysis['affected_paths'].append(path)
 
-        # Count lines
-        elif line.startswith('+') and not line.startswith('+++'):
-            analysis['lines_added'] += 1
-        elif line.startswith('-') and not line.startswith('---'):
-            analysis['lines_deleted'] += 1
+        # Check file extension (same rules as Path.suffix, without the object)
+        name = path[path.rfind('/') + 1:]
+        dot = name.rfind('.')
+        if 0 < dot < len(name) - 1:
+            analysis['modified_extensions'].add(name[dot:].lower())
 
-        i += 1
+        # Categorize files
+        lower_path = path.lower()
+        if _TEST_RE.search(lower_path):
+            analysis['test_files'] += 1
+        elif _CONFIG_RE.search(lower_path):
+            analysis['config_files'] += 1
+        elif _DOC_RE.search(lower_path):
+            analysis['doc_files'] += 1
+
+    analysis['lines_added'] = added
+    analysis['lines_deleted'] = deleted
 
     return analysis
 
+def index_version(git_dir: str) -> int:
+    """Return the format version of the repository's index file, or 0 if unreadable."""
+    try:
+        with open(os.path.join(git_dir, 'index'), 'rb') as f:
+            header = f.read(8)
+    except OSError:
+        return 0
+    if header[:4] != b'DIRC':
+        return 0
+    return int.from_bytes(header[4:8], 'big')
+
+def analyze_staged_changes() -> dict:
+    """Analyze the staged changes, through pygit2 if installed, else the git CLI."""
+    # Imported here rather than at the top: loading libgit2 costs more than
+    # the rest of startup, and --help never needs it.
+    try:
+        import pygit2
+    except ImportError:
+        pygit2 = None  # optional; staged changes are read through the git CLI instead
+
+    if pygit2 is not None and not any(var in os.environ for var in _GIT_LOCATION_VARS):
+        try:
+            repo_path = pygit2.discover_repository(os.getcwd())
+            if repo_path is not None:
+                repo = pygit2.Repository(repo_path)
+                # Leave to the CLI what pygit2 cannot match: no HEAD yet, and
+                # intent-to-add entries (git add -N), which libgit2 reports as
+                # added and pygit2 cannot flag. Git only writes index versions
+                # above 2 when some entry has such extended flags.
+                if not repo.head_is_unborn and index_version(repo.path) == 2:
+                    head_tree = repo.head.peel(pygit2.Tree)
+                    diff = repo.index.diff_to_tree(
+                        head_tree, flags=pygit2.GIT_DIFF_INCLUDE_TYPECHANGE)
+                    return analyze_changes(summarize_diff(repo, diff))
+        except pygit2.GitError:
+            pass  # the CLI reports the problem, or copes with it
+
+    return analyze_changes(get_staged_summary())
+
 def determine_commit_type(analysis: dict) -> str:
     """Determine the conventional commit type based on analysis."""
-    if analysis['test_files'] > 0 and analysis['test_files'] == len(analysis['affected_paths']):
-        return 'test'
-    elif analysis['doc_files'] > 0 and analysis['doc_files'] == len(analysis['affected_paths']):
-        return 'docs'
-    elif analysis['config_files'] > 0 and any(ext in ['.json', '.yml', '.yaml', '.toml', '.ini'] for ext in analysis['modified_extensions']):
-        return 'chore'
-    elif analysis['has_new_files'] and not analysis['has_modified_files'] and not analysis['has_deleted_files']:
-        return 'feat'
-    elif analysis['has_deleted_files'] and not analysis['has_new_files'] and not analysis['has_modified_files']:
-        return 'chore'
-    elif analysis['lines_added'] > analysis['lines_deleted'] * 2:
-        return 'feat'
-    elif analysis['lines_deleted'] > analysis['lines_added'] * 2:
-        return 'refactor'
-    else:
-        return 'fix'
+    n = len(analysis['affected_paths'])
+    test_files = analysis['test_files']
+    doc_files = analysis['doc_files']
+    has_new = analysis['has_new_files']
+    has_deleted = analysis['has_deleted_files']
+    has_modified = analysis['has_modified_files']
+    added = analysis['lines_added']
+    deleted = analysis['lines_deleted']
+
+    # One bit per rule in _TYPE_BY_RULE order; the lowest set bit wins
+    flags = (
+        (0 < test_files == n)
+        | (0 < doc_files == n) << 1
+        | (analysis['config_files'] > 0
+           and not _CONFIG_EXTENSIONS.isdisjoint(analysis['modified_extensions'])) << 2
+        | (has_new and not has_modified and not has_deleted) << 3
+        | (has_deleted and not has_new and not has_modified) << 4
+        | (added > deleted * 2) << 5
+        | (deleted > added * 2) << 6
+    )
+    return _TYPE_BY_RULE.get(flags & -flags, 'fix')
 
 def determine_scope(analysis: dict) -> str:
     """Determine the scope based on affected paths."""
@@ -117,18 +266,18 @@ def determine_scope(analysis: dict) -> str:
         return ''
 
     # Common scopes based on directory structure
-    scopes = []
+    scopes = Counter()
     for path in analysis['affected_paths']:
-        parts = Path(path).parts
-        if len(parts) > 1:
+        top, sep, _ = path.partition('/')
+        if sep:
             # Use first directory as scope
-            scope = parts[0].lower()
-            if scope not in ['src', 'lib', 'app', 'test', 'tests', 'docs']:
-                scopes.append(scope)
+            scope = top.lower()
+            if scope not in _GENERIC_SCOPES:
+                scopes[scope] += 1
 
-    # Return most common scope or first one
+    # Return most common scope, preferring the first seen on a tie
     if scopes:
-        return scopes[0] if len(scopes) == 1 else max(set(scopes), key=scopes.count)
+        return scopes.most_common(1)[0][0]
 
     return ''
 
@@ -164,15 +313,14 @@ def generate_subject(type_hint: str, scope: str, analysis: dict) -> str:
 
 def generate_commit_message() -> None:
     """Main function to generate commit message."""
+    # Analyze changes
+    analysis = analyze_staged_changes()
+
     # Check if there are staged changes
-    staged_diff = get_staged_changes()
-    if not staged_diff:
+    if not analysis['affected_paths']:
         print("No staged changes found. Stage your changes first with 'git add'.")
         return
 
-    # Analyze changes
-    analysis = analyze_changes(staged_diff)
-
     # Determine commit characteristics
     commit_type = determine_commit_type(analysis)
     scope = determine_scope(analysis)
@@ -180,23 +328,25 @@ def generate_commit_message() -> None:
     # Generate subject
     subject = generate_subject(commit_type, scope, analysis)
 
-    print("Suggested commit message:")
-    print("=" * 50)
-    print(subject)
-    print()
-    print("Analysis:")
-    print(f"- Type: {commit_type}")
-    print(f"- Scope: {scope or 'general'}")
-    print(f"- Files changed: {len(analysis['affected_paths'])}")
-    print(f"- Lines added: {analysis['lines_added']}")
-    print(f"- Lines deleted: {analysis['lines_deleted']}")
-    print(f"- New files: {analysis['has_new_files']}")
-    print(f"- Test files: {analysis['test_files']}")
-    print(f"- Config files: {analysis['config_files']}")
-    print(f"- Doc files: {analysis['doc_files']}")
-    print()
-    print("To use this message:")
-    print(f'git commit -m "{subject}"')
+    sys.stdout.write(
+        f"Suggested commit message:\n"
+        f"{_RULE}\n"
+        f"{subject}\n"
+        f"\n"
+        f"Analysis:\n"
+        f"- Type: {commit_type}\n"
+        f"- Scope: {scope or 'general'}\n"
+        f"- Files changed: {len(analysis['affected_paths'])}\n"
+        f"- Lines added: {analysis['lines_added']}\n"
+        f"- Lines deleted: {analysis['lines_deleted']}\n"
+        f"- New files: {analysis['has_new_files']}\n"
+        f"- Test files: {analysis['test_files']}\n"
+        f"- Config files: {analysis['config_files']}\n"
+        f"- Doc files: {analysis['doc_files']}\n"
+        f"\n"
+        f"To use this message:\n"
+        f'git commit -m "{subject}"\n'
+    )
 
 def main():
     """Entry point."""